@@ -5,7 +5,7 @@
 #    python -m venv venv
 #    source venv/bin/activate  # En Windows: venv\Scripts\activate
 # 3. Instala las dependencias:
-#    pip install "fastapi[all]" uvicorn yt-dlp boto3
+#    pip install "fastapi[all]" uvicorn "yt-dlp[default]" boto3
 # 4. Instala ffmpeg:
 #    - Windows: Descarga desde https://ffmpeg.org/download.html y añade el directorio 'bin' a tu PATH.
 #    - macOS (usando Homebrew): brew install ffmpeg
@@ -16,17 +16,42 @@
 #    export AWS_SECRET_ACCESS_KEY="tu_secret_key"
 #    export AWS_REGION="tu_region"
 #    export S3_BUCKET="tu_nombre_de_bucket"
+#    export S3_STREAMING="true"  # Opcional: envía la salida de yt-dlp directamente a S3 sin pasar por disco
+#    export TEMP_DIR="/dev/shm/youtube-downloader"  # Opcional: directorio de descargas temporales
+#    Por defecto se usa un tmpfs (/dev/shm) si tiene al menos 4 GiB libres, para no escribir
+#    los videos en disco; debe tener espacio para los videos en curso. Con systemd se puede usar
+#    'RuntimeDirectory=youtube-downloader' y apuntar TEMP_DIR a /run/youtube-downloader.
 # 6. Ejecuta la aplicación:
 #    uvicorn main:app --host 0.0.0.0 --port 8000
 
 import os
-import uuid
+import sys
+import asyncio
+import hmac
+import hashlib
+import http.client
+import json
+import subprocess
+import tempfile
+import threading
+import time
+import secrets
+from typing import Union
 import logging
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from pathlib import Path
 
+import anyio
 import boto3
+import urllib3
+import urllib3.connection
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError, ClientError
-from fastapi import FastAPI, Request, HTTPException, Security
+from fastapi import FastAPI, Request, HTTPException, Security, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel, Field, HttpUrl
 import uvicorn
@@ -42,6 +67,11 @@ S3_BUCKET = os.getenv("S3_BUCKET")
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_REGION = os.getenv("AWS_REGION")
+# En modo streaming la salida de yt-dlp/ffmpeg se envía directamente a S3 sin
+# escribirse en disco. Los MP4 se generan fragmentados para poder transmitirse;
+# los requests que piden conversión de formato, o cuyo video no se obtiene
+# directamente en el formato pedido, siguen pasando por disco.
+S3_STREAMING = os.getenv("S3_STREAMING", "false").lower() in ("1", "true", "yes")
 
 # --- Validación de configuración ---
 if not API_KEY:
@@ -54,33 +84,202 @@ class DownloadRequest(BaseModel):
     url: HttpUrl = Field(..., description="URL del video de YouTube a descargar.")
     format: str = Field("mp4", description="Formato de salida del archivo.")
     to_s3: bool = Field(True, description="Indica si se debe subir el archivo a S3.")
+    convert: bool = Field(False, description="Recodifica con ffmpeg el video en lugar de solo reempaquetarlo si no se obtiene en el formato pedido. Solo afecta a mp4 y mkv.")
+
+class S3DownloadResponse(BaseModel):
+    file_url: str = Field(..., description="URL prefirmada para descargar el archivo desde S3.")
+
+class LocalDownloadResponse(BaseModel):
+    message: str = Field(..., description="Mensaje descriptivo del resultado.")
+    filename: str = Field(..., description="Nombre del archivo descargado.")
+    local_path: str = Field(..., description="Ruta absoluta del archivo en el servidor.")
 
 # --- Seguridad con API Key ---
 api_key_header = APIKeyHeader(name="Authorization", auto_error=True)
 
+# Caché de headers 'Authorization' ya validados: valor del header -> instante
+# (time.monotonic) en que expira la validación.
+AUTH_CACHE_TTL = 300  # 5 minutos
+_auth_cache = {}
+
 async def get_api_key(key: str = Security(api_key_header)):
     """
     Valida que el API Key enviado en el header 'Authorization' sea correcto.
-    Se espera el formato 'Bearer <clave>'.
+    Se espera el formato 'Bearer <clave>'. Los headers válidos se guardan en
+    caché durante AUTH_CACHE_TTL segundos para no volver a validarlos.
     """
+    now = time.monotonic()
+    expires_at = _auth_cache.get(key)
+    if expires_at and expires_at > now:
+        return API_KEY
+
     if not key.startswith("Bearer "):
         raise HTTPException(
             status_code=401,
             detail="Formato de 'Authorization' header inválido. Usar 'Bearer <clave>'.",
         )
-    token = key.split(" ")[1]
-    if token != API_KEY:
+    token = key[len("Bearer "):]
+    if not hmac.compare_digest(token.encode(), API_KEY.encode()):
         raise HTTPException(status_code=401, detail="API Key inválido o expirado.")
+    _auth_cache[key] = now + AUTH_CACHE_TTL
     return token
 
+# --- Parámetros de la subida a S3 ---
+# Por encima de 'multipart_threshold' el archivo se sube en partes de
+# 'multipart_chunksize' (S3 exige >= 5 MiB salvo la última) con hasta
+# 'max_concurrency' partes en vuelo a la vez.
+TRANSFER_CFG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=16,
+    use_threads=True,
+)
+PRESIGNED_URL_EXPIRES = 3600  # 1 hora
+S3_CLIENT_CONFIG = Config(max_pool_connections=32, tcp_keepalive=True)
+
+# Buffer de escritura de 1 MiB para las conexiones HTTP (por defecto 8-16 KiB),
+# para que las subidas de archivos grandes no se fragmenten en escrituras pequeñas.
+HTTP_BLOCKSIZE = 1024 * 1024
+http.client.HTTPConnection.__init__.__defaults__ = (
+    http.client.HTTPConnection.__init__.__defaults__[:-1] + (HTTP_BLOCKSIZE,)
+)
+if "blocksize" in (urllib3.connection.HTTPConnection.__init__.__kwdefaults__ or {}):
+    urllib3.connection.HTTPConnection.__init__.__kwdefaults__["blocksize"] = HTTP_BLOCKSIZE
+
+# --- Recursos compartidos (se crean una sola vez por proceso) ---
+@lru_cache(maxsize=1)
+def get_s3_client():
+    """
+    Devuelve el cliente de S3 de la aplicación. Se crea en la primera llamada
+    y se reutiliza después, evitando cargar los modelos del servicio en cada
+    request y permitiendo reutilizar las conexiones.
+    """
+    return boto3.client(
+        's3',
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        region_name=AWS_REGION,
+        config=S3_CLIENT_CONFIG,
+    )
+
+@lru_cache(maxsize=1)
+def get_ydl_base_opts():
+    """
+    Devuelve las opciones de yt-dlp comunes a todas las descargas. El diccionario
+    es compartido: se debe copiar antes de añadir opciones por request.
+    """
+    return {
+        'logger': logger,
+        'progress_hooks': [], # Se puede usar para monitorear el progreso
+        'noplaylist': True, # Evita descargar listas de reproducción completas
+    }
+
+# --- Formatos de salida admitidos ---
+ALLOWED_FORMATS = frozenset({"mp4", "webm", "mkv", "m4a"})
+AUDIO_FORMATS = frozenset({"m4a"})  # Solo audio: no hay video que fusionar
+# Formatos en los que 'convert' cambia el resultado: el resto ya se recodifica
+# cuando hace falta (WebM) o se extrae el audio (formatos de solo audio)
+CONVERT_FORMATS = frozenset({"mp4", "mkv"})
+
+# Selección de formato de yt-dlp para cada formato admitido.
+# 'bestvideo[ext=mp4]+bestaudio/best[ext=mp4]/best'
+# 1. Intenta obtener el mejor video en MP4 y el mejor audio y fusionarlos.
+# 2. Si no es posible, obtiene el mejor formato pre-fusionado en MP4.
+# 3. Como último recurso, obtiene el mejor formato disponible.
+# WebM solo admite audio Vorbis/Opus, por eso su audio también se pide en WebM;
+# MKV admite cualquier códec, así que siempre se puede fusionar lo mejor. Los
+# formatos de solo audio eligen la mejor pista de audio (o extraen el audio de
+# un video si no hay pistas sueltas).
+FORMAT_SELECTORS = {
+    "mp4": "bestvideo[ext=mp4]+bestaudio/best[ext=mp4]/best",
+    "webm": "bestvideo[ext=webm]+bestaudio[ext=webm]/best[ext=webm]/best",
+    "mkv": "bestvideo+bestaudio/best",
+    "m4a": "bestaudio[ext=m4a]/bestaudio/best",
+}
+
+def _default_postprocessors(fmt: str) -> list:
+    """
+    Postprocesadores que garantizan que el archivo final está en el formato
+    pedido. yt-dlp los omite si la descarga ya tiene esa extensión, así que
+    ffmpeg solo se ejecuta cuando se obtuvo otro contenedor.
+    """
+    if fmt in AUDIO_FORMATS:
+        # Copia el audio si el códec es compatible; si no, lo recodifica
+        return [{'key': 'FFmpegExtractAudio', 'preferredcodec': fmt}]
+    if fmt == "webm":
+        # Un respaldo en MP4 (H.264/AAC) no se puede reempaquetar en WebM
+        return [{'key': 'FFmpegVideoConvertor', 'preferedformat': fmt}]
+    # Reempaqueta sin recodificar ('-c copy')
+    return [{'key': 'FFmpegVideoRemuxer', 'preferedformat': fmt}]
+
+# En modo streaming yt-dlp no ejecuta postprocesadores sobre la salida: solo se
+# admiten las alternativas que ya dan el contenedor pedido (sin el 'best' final).
+# Los formatos de solo audio no se transmiten porque yt-dlp los repara con ffmpeg.
+STREAM_FORMAT_SELECTORS = {
+    "mp4": "bestvideo[ext=mp4]+bestaudio/best[ext=mp4]",
+    "webm": "bestvideo[ext=webm]+bestaudio[ext=webm]/best[ext=webm]",
+    "mkv": "bestvideo+bestaudio/best[ext=mkv]",
+}
+
+# Opciones de yt-dlp precalculadas para cada formato admitido; por request solo
+# se añade 'outtmpl'. La fusión de yt-dlp ya copia los streams sin recodificar;
+# la recodificación con FFmpegVideoConvertor solo se fuerza si el request la pide.
+YDL_OPTS_TEMPLATES = {
+    fmt: {
+        **get_ydl_base_opts(),
+        'format': FORMAT_SELECTORS[fmt],
+        'postprocessors': _default_postprocessors(fmt),
+        **({} if fmt in AUDIO_FORMATS else {'merge_output_format': fmt}),
+    }
+    for fmt in ALLOWED_FORMATS
+}
+
+# Pool de conexiones HTTP compartido por todas las descargas por rangos, para
+# reutilizar las conexiones TLS con los servidores de video entre partes y requests.
+# Sin timeout, una conexión atascada dejaría colgado el request (y a todos los
+# que esperan la misma subida), así que se limitan la espera y los reintentos.
+HTTP_POOL = urllib3.PoolManager(
+    num_pools=16,
+    maxsize=32,
+    timeout=urllib3.Timeout(connect=10, read=30),
+    retries=urllib3.Retry(total=3, backoff_factor=0.5),
+)
+
 # --- Ciclo de vida de la aplicación para crear un directorio temporal ---
-TEMP_DIR = "temp_downloads"
+# Los archivos se escriben una vez, se leen una vez y se borran: en un tmpfs
+# (memoria) se evita la escritura a disco. Solo se usa /dev/shm por defecto si
+# tiene espacio libre suficiente (en Docker mide 64 MiB), si no se usa el disco.
+TMPFS_MIN_FREE = 4 * 1024 * 1024 * 1024  # 4 GiB
+
+def _default_temp_dir() -> str:
+    """
+    Devuelve el directorio temporal por defecto: /dev/shm si existe y tiene al
+    menos TMPFS_MIN_FREE bytes libres, o 'temp_downloads' en caso contrario.
+    """
+    try:
+        stats = os.statvfs("/dev/shm")
+    except (AttributeError, OSError):  # Windows no tiene statvfs
+        return "temp_downloads"
+    if stats.f_bavail * stats.f_frsize < TMPFS_MIN_FREE:
+        return "temp_downloads"
+    return "/dev/shm/youtube-downloader"
+
+TEMP_DIR = os.getenv("TEMP_DIR") or _default_temp_dir()
+# El directorio de trabajo no cambia, así que la ruta absoluta se calcula una vez
+ABS_TEMP_DIR = os.path.abspath(TEMP_DIR)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Al iniciar, crea el directorio temporal si no existe
     os.makedirs(TEMP_DIR, exist_ok=True)
-    logger.info(f"Directorio temporal '{TEMP_DIR}' asegurado.")
+    logger.info("Directorio temporal '%s' asegurado.", TEMP_DIR)
+    # Precarga los extractores de yt-dlp para no pagar su inicialización en el primer request
+    await anyio.to_thread.run_sync(_get_ydl, "mp4")
+    logger.info("Extractores de yt-dlp inicializados.")
+    # Crea el cliente de S3 por adelantado para no pagar su coste en el primer request
+    if all([S3_BUCKET, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION]):
+        get_s3_client()
+        logger.info("Cliente de S3 inicializado.")
     yield
     # Al finalizar, se podrían limpiar archivos residuales si es necesario,
     # aunque la lógica actual limpia por cada request.
@@ -92,100 +291,436 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# --- Funciones bloqueantes (se ejecutan en un hilo de trabajo) ---
+# Instancias de YoutubeDL por hilo de trabajo y formato. Crear una instancia
+# inicializa todos los extractores, así que se reutilizan entre requests; al ser
+# una por hilo, dos descargas simultáneas nunca comparten la misma instancia.
+# Como no se cierran, su sesión HTTP (yt-dlp[default] usa 'requests') mantiene
+# abiertas las conexiones con YouTube entre descargas.
+_ydl_local = threading.local()
+
+def _get_ydl(output_format: str, convert: bool = False):
+    """
+    Devuelve la instancia de YoutubeDL del hilo actual para el formato dado,
+    creándola la primera vez. Los postprocesadores se registran al crear la
+    instancia, por eso las que convierten el formato son instancias aparte.
+    """
+    instances = getattr(_ydl_local, "instances", None)
+    if instances is None:
+        instances = _ydl_local.instances = {}
+    ydl = instances.get((output_format, convert))
+    if ydl is None:
+        # YoutubeDL modifica sus parámetros, por eso recibe una copia de la plantilla
+        ydl_opts = dict(YDL_OPTS_TEMPLATES[output_format])
+        if convert and output_format in CONVERT_FORMATS:
+            ydl_opts['postprocessors'] = [{
+                'key': 'FFmpegVideoConvertor',
+                'preferedformat': output_format,
+            }]
+        ydl = instances[(output_format, convert)] = yt_dlp.YoutubeDL(ydl_opts)
+    return ydl
+
+def _run_ydl(output_format: str, convert: bool, output_path: str, url: str, info: dict = None):
+    """
+    Ejecuta la descarga con la instancia de YoutubeDL del hilo de trabajo
+    actual. Si ya se extrajo la información del video, se reutiliza en lugar
+    de volver a consultarla.
+    """
+    ydl = _get_ydl(output_format, convert)
+    # La extensión la pone yt-dlp según lo descargado; los postprocesadores
+    # dejan el archivo final en 'output_path', con la extensión pedida
+    ydl.params['outtmpl']['default'] = os.path.splitext(output_path)[0] + '.%(ext)s'
+    if info is None:
+        ydl.download([url])
+    else:
+        ydl.process_ie_result(info, download=True)
+
+def _upload_part(s3_client, bucket: str, key: str, upload_id: str, part_number: int, read_chunk, offset: int, length: int):
+    """
+    Obtiene los bytes de una parte con 'read_chunk' y la sube como parte de una
+    subida multiparte.
+    """
+    data = read_chunk(offset, length)
+    response = s3_client.upload_part(
+        Bucket=bucket,
+        Key=key,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=data,
+    )
+    return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+def _multipart_upload(s3_client, bucket: str, key: str, size: int, read_chunk):
+    """
+    Sube 'size' bytes a S3 divididos en partes que se obtienen y envían en
+    paralelo desde un pool de hilos; 'read_chunk(offset, length)' devuelve los
+    bytes de cada parte. Si alguna parte falla, la subida multiparte se aborta
+    para no dejar partes huérfanas en el bucket.
+    """
+    chunksize = TRANSFER_CFG.multipart_chunksize
+
+    upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+    try:
+        with ThreadPoolExecutor(max_workers=TRANSFER_CFG.max_concurrency) as executor:
+            futures = [
+                executor.submit(
+                    _upload_part, s3_client, bucket, key, upload_id, part_number,
+                    read_chunk, offset, min(chunksize, size - offset),
+                )
+                for part_number, offset in enumerate(range(0, size, chunksize), start=1)
+            ]
+            try:
+                parts = [future.result() for future in futures]
+            except Exception:
+                # Cancela las partes que aún no han empezado: al salir del bloque
+                # 'with' el pool espera a las pendientes antes de poder abortar
+                for future in futures:
+                    future.cancel()
+                raise
+
+        s3_client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+def _upload_multipart(s3_client, file_path: str, bucket: str, key: str):
+    """
+    Sube un archivo a S3 en partes paralelas. Los archivos por debajo del umbral
+    de TRANSFER_CFG se suben con una única petición.
+    """
+    file_size = os.path.getsize(file_path)
+    if file_size < TRANSFER_CFG.multipart_threshold:
+        s3_client.upload_file(file_path, bucket, key, Config=TRANSFER_CFG)
+        return
+
+    def read_chunk(offset: int, length: int) -> bytes:
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    _multipart_upload(s3_client, bucket, key, file_size, read_chunk)
+
+def _extract_info(output_format: str, url: str) -> dict:
+    """
+    Extrae la información del video y selecciona el formato sin descargarlo.
+    """
+    return _get_ydl(output_format).extract_info(url, download=False)
+
+def _is_dash_container(info: dict) -> bool:
+    """
+    Indica si el formato seleccionado es un fragmento DASH (p. ej. el audio m4a
+    de YouTube, 'm4a_dash'), que yt-dlp repara con ffmpeg al descargarlo porque
+    no todos los reproductores lo admiten tal cual.
+    """
+    return (info.get('container') or '').endswith('_dash')
+
+def _can_transfer_by_ranges(info: dict, output_format: str) -> bool:
+    """
+    Indica si el formato seleccionado es un único archivo HTTP de tamaño conocido
+    en el formato pedido, de modo que se puede copiar a S3 por rangos sin que
+    yt-dlp tenga que fusionarlo, convertirlo ni repararlo.
+    """
+    return (
+        info.get('_type') in (None, 'video')
+        and info.get('requested_formats') is None
+        and info.get('protocol') in ('http', 'https')
+        and info.get('ext') == output_format
+        and not _is_dash_container(info)
+        and bool(info.get('filesize'))
+    )
+
+class RangeTransferError(Exception):
+    """
+    El servidor del video no respondió a una petición por rangos como se
+    esperaba; el archivo se puede seguir descargando con yt-dlp.
+    """
+
+def _transfer_ranges_to_s3(s3_client, info: dict, bucket: str, key: str):
+    """
+    Copia el archivo del video a S3 descargándolo con peticiones HTTP por rangos
+    en paralelo; cada rango se sube como una parte de la subida multiparte.
+    Lanza RangeTransferError si el servidor no atiende los rangos.
+    """
+    url = info['url']
+    headers = info.get('http_headers') or {}
+
+    def read_chunk(offset: int, length: int) -> bytes:
+        byte_range = f"{offset}-{offset + length - 1}"
+        try:
+            # Sin precargar el cuerpo: si el servidor ignora el rango y envía el
+            # archivo completo, se descarta la respuesta sin leerla
+            response = HTTP_POOL.request(
+                "GET",
+                url,
+                headers={**headers, "Range": f"bytes={byte_range}"},
+                preload_content=False,
+            )
+        except urllib3.exceptions.HTTPError as e:
+            raise RangeTransferError(f"Error al descargar el rango {byte_range}: {e}") from e
+        try:
+            content_range = response.headers.get("Content-Range", "")
+            if response.status != 206 or not content_range.startswith(f"bytes {byte_range}/"):
+                # Cierra la conexión en lugar de vaciar un cuerpo que no se usará
+                response.close()
+                raise RangeTransferError(
+                    f"Respuesta inesperada al descargar el rango {byte_range}: "
+                    f"HTTP {response.status}, Content-Range '{content_range}'"
+                )
+            data = response.read(length)
+        except urllib3.exceptions.HTTPError as e:
+            response.close()
+            raise RangeTransferError(f"Error al descargar el rango {byte_range}: {e}") from e
+        if len(data) != length:
+            response.close()
+            raise RangeTransferError(f"Respuesta incompleta al descargar el rango {byte_range}")
+        response.release_conn()
+        return data
+
+    _multipart_upload(s3_client, bucket, key, info['filesize'], read_chunk)
+
+def _can_stream(info: dict, output_format: str) -> bool:
+    """
+    Indica si el formato seleccionado se puede transmitir a S3 sin
+    postprocesado: o bien se fusiona con ffmpeg en el contenedor pedido, o bien
+    es un único archivo con esa extensión que no necesita reparación.
+    """
+    if output_format not in STREAM_FORMAT_SELECTORS:
+        return False
+    if info.get('requested_formats'):
+        return True
+    return info.get('ext') == output_format and not _is_dash_container(info)
+
+def _stream_to_s3(s3_client, info: dict, output_format: str, bucket: str, key: str):
+    """
+    Ejecuta yt-dlp en un subproceso escribiendo en stdout y sube esa salida a S3
+    a medida que se produce, sin guardar el video en disco. El subproceso recibe
+    la información ya extraída, así que no vuelve a consultar el video.
+    """
+    # stderr va a un archivo temporal para que un stderr lleno no bloquee stdout
+    with tempfile.NamedTemporaryFile("w", suffix=".info.json") as info_file, \
+            tempfile.TemporaryFile() as stderr_file:
+        json.dump(yt_dlp.YoutubeDL.sanitize_info(info), info_file)
+        info_file.flush()
+
+        cmd = [
+            sys.executable, "-m", "yt_dlp",
+            "--quiet", "--no-warnings", "--no-playlist", "--no-progress",
+            "--load-info-json", info_file.name,
+            "--format", STREAM_FORMAT_SELECTORS[output_format],
+            "--merge-output-format", output_format,
+            "--output", "-",
+        ]
+        if output_format == "mp4":
+            # MP4 fragmentado: se puede escribir de forma secuencial en un pipe
+            cmd += ["--downloader-args", "ffmpeg_o:-f mp4 -movflags frag_keyframe+empty_moov"]
+
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file)
+        try:
+            s3_client.upload_fileobj(proc.stdout, bucket, key, Config=TRANSFER_CFG)
+        except Exception:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+
+        if returncode != 0:
+            # La subida terminó con una salida incompleta: se elimina el objeto
+            s3_client.delete_object(Bucket=bucket, Key=key)
+            stderr_file.seek(0)
+            error = stderr_file.read().decode(errors="replace").strip()
+            raise yt_dlp.utils.DownloadError(error or f"yt-dlp terminó con código {returncode}")
+
+def _generate_file_url(s3_client, key: str) -> str:
+    """
+    Genera la URL prefirmada de descarga de un objeto del bucket. El firmante
+    pertenece al cliente compartido, así que no se reconstruye en cada llamada.
+    """
+    return s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': S3_BUCKET, 'Key': key},
+        ExpiresIn=PRESIGNED_URL_EXPIRES,
+    )
+
+def _remove_temp_file(path: str):
+    """
+    Elimina un archivo temporal, registrando el error si no se puede borrar.
+    Si el archivo no existe no hace nada.
+    """
+    try:
+        Path(path).unlink(missing_ok=True)
+        logger.info("Archivo temporal '%s' eliminado.", path)
+    except OSError as e:
+        logger.error("Error al eliminar el archivo temporal '%s': %s", path, e)
+
+# --- Deduplicación de subidas a S3 simultáneas ---
+# Las URLs se guardan la mitad de su validez, para que una URL reutilizada
+# siempre conserve al menos media hora de vigencia. Ambos diccionarios solo se
+# usan desde el event loop, así que no necesitan lock.
+RESULT_CACHE_TTL = PRESIGNED_URL_EXPIRES // 2
+_inflight = {}  # clave -> asyncio.Future con la URL prefirmada de la subida en curso
+_results = {}  # clave -> (instante de expiración, URL prefirmada)
+
 # --- Endpoint de descarga ---
-@app.post("/download", dependencies=[Security(get_api_key)])
-async def download_video(request: DownloadRequest):
+# Declarar el modelo de respuesta permite a FastAPI serializar la respuesta
+# directamente a JSON con Pydantic, sin pasar por el módulo json estándar.
+@app.post(
+    "/download",
+    response_model=Union[S3DownloadResponse, LocalDownloadResponse],
+    dependencies=[Security(get_api_key)],
+)
+async def download_video(request: DownloadRequest, background_tasks: BackgroundTasks):
     """
     Descarga un video de YouTube, opcionalmente lo sube a S3 y devuelve una URL
     prefirmada o la ruta local del archivo.
+
+    El trabajo bloqueante se ejecuta en el pool de hilos; los requests que
+    esperan una subida en curso lo hacen en el event loop, sin ocupar un hilo.
     """
-    unique_id = uuid.uuid4()
-    output_filename = f"{unique_id}.{request.format}"
-    output_path = os.path.join(TEMP_DIR, output_filename)
-    
-    # Opciones para yt-dlp
-    # 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
-    # 1. Intenta obtener el mejor video en MP4 y el mejor audio en M4A y fusionarlos.
-    # 2. Si no es posible, obtiene el mejor formato pre-fusionado en MP4.
-    # 3. Como último recurso, obtiene el mejor formato disponible.
-    ydl_opts = {
-        'format': f'bestvideo[ext={request.format}]+bestaudio/best',
-        'outtmpl': output_path,
-        'merge_output_format': request.format,
-        'postprocessors': [{
-            'key': 'FFmpegVideoConvertor',
-            'preferedformat': request.format,
-        }],
-        'logger': logger,
-        'progress_hooks': [], # Se puede usar para monitorear el progreso
-        'noplaylist': True, # Evita descargar listas de reproducción completas
-    }
+    if request.format not in ALLOWED_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Formato no admitido. Formatos válidos: {', '.join(sorted(ALLOWED_FORMATS))}.",
+        )
+
+    if request.format not in CONVERT_FORMATS:
+        # 'convert' no tiene efecto: se ignora para no duplicar la clave de
+        # deduplicación ni las instancias de YoutubeDL por hilo
+        request.convert = False
+
+    if not request.to_s3:
+        return await run_in_threadpool(_download_video, request, background_tasks)
+
+    # Las subidas a S3 del mismo video y opciones se comparten: si ya hay una en
+    # curso se espera su resultado, y si terminó hace poco se reutiliza su URL.
+    dedup_key = hashlib.blake2b(f"{request.url}|{request.format}|{request.convert}".encode()).hexdigest()
+    cached = _results.get(dedup_key)
+    if cached and cached[0] > time.monotonic():
+        logger.info("Reutilizando la subida reciente de URL: %s", request.url)
+        return {"file_url": cached[1]}
 
-    logger.info(f"Iniciando descarga para URL: {request.url} con ID: {unique_id}")
+    future = _inflight.get(dedup_key)
+    if future is not None:
+        logger.info("Esperando la descarga en curso de URL: %s", request.url)
+        # shield: si este request se cancela, la subida compartida sigue adelante
+        return {"file_url": await asyncio.shield(future)}
 
+    future = _inflight[dedup_key] = asyncio.get_running_loop().create_future()
     try:
-        # Ejecutar la descarga de yt-dlp
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([str(request.url)])
-        
-        logger.info(f"Descarga completada. Archivo guardado en: {output_path}")
+        response = await run_in_threadpool(_download_video, request, background_tasks)
+    except Exception as e:
+        future.set_exception(e)
+        # Marca la excepción como consultada por si ningún request la esperaba
+        future.exception()
+        raise
+    else:
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _) in _results.items() if expires_at <= now]:
+            del _results[key]
+        _results[dedup_key] = (now + RESULT_CACHE_TTL, response["file_url"])
+        future.set_result(response["file_url"])
+        return response
+    finally:
+        del _inflight[dedup_key]
+        if not future.done():
+            # Este request se canceló: los que esperaban reciben la cancelación
+            future.cancel()
 
-        if not os.path.exists(output_path):
-             raise HTTPException(status_code=500, detail="El archivo no se generó después de la descarga.")
+def _download_video(request: DownloadRequest, background_tasks: BackgroundTasks):
+    """
+    Realiza la descarga de un request ya validado y devuelve el cuerpo de la
+    respuesta.
+    """
+    needs_cleanup = False  # Hay un archivo en disco que aún no se ha programado borrar
+    unique_id = secrets.token_hex(16)
+    output_filename = f"{unique_id}.{request.format}"
+    output_path = os.path.join(ABS_TEMP_DIR, output_filename)
+
+    logger.info("Iniciando descarga para URL: %s con ID: %s", request.url, unique_id)
 
+    try:
         if request.to_s3:
             if not all([S3_BUCKET, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION]):
                  raise HTTPException(status_code=501, detail="El servidor no está configurado para subir a S3.")
-            
+            s3_client = get_s3_client()
+
+        info = None
+        if request.to_s3:
+            # Extraer antes la información para saber si se puede transmitir o
+            # copiar a S3 por rangos sin pasar por disco
+            info = _extract_info(request.format, str(request.url))
+
+        uploaded = False
+        # El modo streaming no admite conversión ni postprocesado: en esos casos
+        # se descarga a disco
+        if S3_STREAMING and info is not None and not request.convert and _can_stream(info, request.format):
+            # Transmitir la salida de yt-dlp directamente a S3, sin pasar por disco
+            logger.info("Transmitiendo '%s' al bucket '%s'...", output_filename, S3_BUCKET)
+            _stream_to_s3(s3_client, info, request.format, S3_BUCKET, output_filename)
+            uploaded = True
+        elif info is not None and _can_transfer_by_ranges(info, request.format):
+            # Archivo único: se descarga por rangos en paralelo directamente hacia S3
+            logger.info("Transfiriendo '%s' al bucket '%s' por rangos...", output_filename, S3_BUCKET)
             try:
-                s3_client = boto3.client(
-                    's3',
-                    aws_access_key_id=AWS_ACCESS_KEY_ID,
-                    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                    region_name=AWS_REGION
-                )
-                
-                logger.info(f"Subiendo '{output_filename}' al bucket '{S3_BUCKET}'...")
-                s3_client.upload_file(output_path, S3_BUCKET, output_filename)
-                
-                logger.info("Generando URL prefirmada...")
-                presigned_url = s3_client.generate_presigned_url(
-                    'get_object',
-                    Params={'Bucket': S3_BUCKET, 'Key': output_filename},
-                    ExpiresIn=3600  # 1 hora
-                )
-                
-                return {"file_url": presigned_url}
-
-            except (NoCredentialsError, PartialCredentialsError):
-                logger.error("Credenciales de AWS no encontradas.")
-                raise HTTPException(status_code=500, detail="Error de configuración de credenciales de AWS.")
-            except ClientError as e:
-                logger.error(f"Error de cliente de S3: {e}")
-                raise HTTPException(status_code=500, detail=f"Error al interactuar con S3: {e}")
-        
-        else:
-            # Devolver la ruta local si no se sube a S3
-            return {
-                "message": "Archivo descargado localmente.",
-                "filename": output_filename,
-                "local_path": os.path.abspath(output_path)
-            }
+                _transfer_ranges_to_s3(s3_client, info, S3_BUCKET, output_filename)
+                uploaded = True
+            except RangeTransferError as e:
+                # El servidor no admite rangos: se descarga con yt-dlp como siempre
+                logger.warning("No se pudo transferir por rangos, se descarga con yt-dlp: %s", e)
 
+        if not uploaded:
+            # Ejecutar la descarga de yt-dlp
+            needs_cleanup = True
+            _run_ydl(request.format, request.convert, output_path, str(request.url), info)
+
+            logger.info("Descarga completada. Archivo guardado en: %s", output_path)
+
+            if not request.to_s3:
+                # Devolver la ruta local si no se sube a S3; el archivo se
+                # elimina después de enviar la respuesta
+                background_tasks.add_task(_remove_temp_file, output_path)
+                needs_cleanup = False
+                return {
+                    "message": "Archivo descargado localmente.",
+                    "filename": output_filename,
+                    "local_path": output_path
+                }
+
+            logger.info("Subiendo '%s' al bucket '%s'...", output_filename, S3_BUCKET)
+            _upload_multipart(s3_client, output_path, S3_BUCKET, output_filename)
+            # El archivo ya está en S3: se elimina después de enviar la respuesta
+            background_tasks.add_task(_remove_temp_file, output_path)
+            needs_cleanup = False
+
+        logger.info("Generando URL prefirmada...")
+        presigned_url = _generate_file_url(s3_client, output_filename)
+
+        return {"file_url": presigned_url}
+
+    except (NoCredentialsError, PartialCredentialsError):
+        logger.error("Credenciales de AWS no encontradas.")
+        raise HTTPException(status_code=500, detail="Error de configuración de credenciales de AWS.")
+    except ClientError as e:
+        logger.error("Error de cliente de S3: %s", e)
+        raise HTTPException(status_code=500, detail=f"Error al interactuar con S3: {e}")
     except yt_dlp.utils.DownloadError as e:
-        logger.error(f"Error de yt-dlp: {e}")
+        logger.error("Error de yt-dlp: %s", e)
         raise HTTPException(status_code=400, detail=f"No se pudo descargar el video. Causa: {str(e)}")
     except Exception as e:
-        logger.error(f"Un error inesperado ocurrió: {e}")
+        logger.error("Un error inesperado ocurrió: %s", e)
         raise HTTPException(status_code=500, detail=f"Error interno del servidor: {str(e)}")
     finally:
-        # Limpieza del archivo temporal
-        if os.path.exists(output_path):
-            try:
-                os.remove(output_path)
-                logger.info(f"Archivo temporal '{output_path}' eliminado.")
-            except OSError as e:
-                logger.error(f"Error al eliminar el archivo temporal '{output_path}': {e}")
+        # Si hubo un error, FastAPI no ejecuta las tareas en segundo plano de la
+        # respuesta, así que el archivo temporal se elimina aquí mismo
+        if needs_cleanup:
+            # Incluye archivos intermedios (.part, o el original si falló la conversión)
+            for path in Path(ABS_TEMP_DIR).glob(f"{unique_id}.*"):
+                _remove_temp_file(str(path))
 
 # --- Bloque para ejecución directa con uvicorn ---
 if __name__ == "__main__":